@@ -1,25 +1,50 @@
 # -*- coding: utf-8 -*-
 
-"""
+"""Correlate cold baths with sleep data from Oura."""
 
 import datetime as dt
+import json
+import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import List, Optional
+from functools import lru_cache
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Set
+
+try:
+    import numpy as np
+except ModuleNotFoundError as exc:  # pragma: no cover - simple guard
+    raise SystemExit("The 'numpy' package is required. Install it via 'pip install numpy'.") from exc
 
 try:
     import requests  # Requires installation of the 'requests' package
+    from requests.adapters import HTTPAdapter
 except ModuleNotFoundError as exc:  # pragma: no cover - simple guard
     raise SystemExit("The 'requests' package is required. Install it via 'pip install requests'.") from exc
 
+if TYPE_CHECKING:  # pragma: no cover - matplotlib is imported lazily
+    from matplotlib.figure import Figure
+
 try:
-    import matplotlib.pyplot as plt
-except ModuleNotFoundError as exc:  # pragma: no cover - simple guard
-    raise SystemExit("The 'matplotlib' package is required. Install it via 'pip install matplotlib'.") from exc
+    from orjson import loads as _json_loads
+except ModuleNotFoundError:  # pragma: no cover - optional speedup
+    _json_loads = json.loads
+
+logger = logging.getLogger(__name__)
 
 # Folder where daily plots will be stored
 EXPORT_DIR = r"C:\Users\JesperGunnarson\Dropbox\J Privat\Health\Kallbad"
 
+# Per-day API responses are cached here. An entry is final once it was
+# written CACHE_SETTLE after its day ended (late syncs have landed by then);
+# younger entries are refetched when older than CACHE_TTL, so a daily run
+# refreshes today and the two days before it.
+CACHE_DIR = os.path.join(EXPORT_DIR, ".cache")
+CACHE_TTL = 60 * 60  # seconds
+CACHE_SETTLE = dt.timedelta(days=1)
+
 # Credentials for API access
 CREDENTIALS = {
     # Set this environment variable before running the script
@@ -29,127 +54,320 @@ CREDENTIALS = {
 OURA_SLEEP_ENDPOINT = "https://api.ouraring.com/v2/usercollection/daily_sleep"
 OURA_WORKOUT_ENDPOINT = "https://api.ouraring.com/v2/usercollection/workout"
 
-@dataclass
-class SleepRecord:
-    date: dt.date
-    total_sleep_duration: float  # seconds
-    deep_sleep_duration: Optional[float] = None
-    rest_hr: Optional[float] = None
+# Shared HTTP session so both endpoints reuse the same keep-alive connection
+_SESSION: Optional[requests.Session] = None
+_SESSION_LOCK = threading.Lock()
+
+# Directories already created during this run
+_ensured_dirs: Set[str] = set()
+
+@dataclass(slots=True)
+class SleepData:
+    # One entry per night, stored column-wise; missing values are NaN
+    date: np.ndarray  # datetime64[D]
+    total_sleep: np.ndarray  # seconds
+    deep: np.ndarray  # seconds
+    rest_hr: np.ndarray
 
-@dataclass
+    def __len__(self) -> int:
+        return len(self.date)
+
+@dataclass(slots=True)
 class ColdBathRecord:
     date: dt.date
 
 
-def fetch_oura_sleep(start_date: dt.date, end_date: dt.date) -> List[SleepRecord]:
-    """Fetch sleep data from Oura between start_date and end_date."""
-    token = CREDENTIALS["oura_token"]
-    if not token:
-        raise EnvironmentError("OURA_TOKEN is not set")
+def _ensure_dir(path: str) -> None:
+    """Create ``path`` if needed, touching the filesystem once per directory."""
+    if path not in _ensured_dirs:
+        os.makedirs(path, exist_ok=True)
+        _ensured_dirs.add(path)
+
+
+@lru_cache(maxsize=4096)
+def _parse_date(date_str: str) -> dt.date:
+    """Parse a ``YYYY-MM-DD`` string by slicing instead of ``fromisoformat``."""
+    return dt.date(int(date_str[0:4]), int(date_str[5:7]), int(date_str[8:10]))
+
+
+def _get_session() -> requests.Session:
+    """Return the shared Oura session, creating it on first use."""
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            token = CREDENTIALS["oura_token"]
+            if not token:
+                raise EnvironmentError("OURA_TOKEN is not set")
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=10))
+            # requests already advertises "Accept-Encoding: gzip, deflate" and
+            # decompresses transparently, so responses arrive compressed
+            session.headers.update({"Authorization": f"Bearer {token}"})
+            _SESSION = session
+        return _SESSION
+
+
+def _cache_path(endpoint: str, day: dt.date) -> str:
+    """Return the cache file holding ``endpoint``'s entries for ``day``."""
+    name = endpoint.rsplit("/", 1)[-1]
+    return os.path.join(CACHE_DIR, f"{name}_{day.isoformat()}.json")
+
+
+def _read_cached_day(endpoint: str, day: dt.date) -> Optional[List[dict]]:
+    """Return the cached entries for ``day``, or None if missing or stale."""
+    cache_path = _cache_path(endpoint, day)
+    if not os.path.exists(cache_path):
+        return None
+    mtime = os.path.getmtime(cache_path)
+    settled = dt.datetime.combine(day + dt.timedelta(days=1) + CACHE_SETTLE, dt.time())
+    if mtime < settled.timestamp() and time.time() - mtime >= CACHE_TTL:
+        return None
+    with open(cache_path, "rb") as f:
+        return _json_loads(f.read())
+
+
+def _write_cached_day(endpoint: str, day: dt.date, data: List[dict]) -> None:
+    """Store the entries for ``day`` in the cache."""
+    cache_path = _cache_path(endpoint, day)
+    # Write to a temporary file first so an interrupted run never leaves a
+    # truncated cache entry behind
+    _ensure_dir(CACHE_DIR)
+    tmp_path = f"{cache_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, cache_path)
+
+
+def _entry_day(entry: dict) -> str:
+    """Return the ``YYYY-MM-DD`` day an Oura sleep or workout entry belongs to."""
+    day = entry.get("day") or entry.get("summary_date")
+    if day:
+        return day
+    return (entry.get("start_datetime") or entry.get("start_time") or "")[:10]
+
+
+def _fetch_range(endpoint: str, start_date: dt.date, end_date: dt.date) -> List[dict]:
+    """Return the Oura ``data`` entries for every day from start_date to end_date.
+
+    Leading days with a usable cache entry are read from disk. Everything from
+    the first missing or unsettled day onwards is fetched in one range request
+    and split back into per-day cache files.
+    """
+    data: List[dict] = []
+    day = start_date
+    while day <= end_date:
+        cached = _read_cached_day(endpoint, day)
+        if cached is None:
+            break
+        data.extend(cached)
+        day += dt.timedelta(days=1)
+    if day > end_date:
+        return data
+
+    params = {"start_date": day.isoformat(), "end_date": end_date.isoformat()}
+    resp = _get_session().get(endpoint, params=params, timeout=30)
+    resp.raise_for_status()
+    fetched = _json_loads(resp.content).get("data", [])
 
-    headers = {
-        "Authorization": f"Bearer {token}"
-    }
-    params = {
-        "start_date": start_date.isoformat(),
-        "end_date": end_date.isoformat(),
+    by_day: Dict[str, List[dict]] = {
+        (day + dt.timedelta(days=i)).isoformat(): []
+        for i in range((end_date - day).days + 1)
     }
-
-    resp = requests.get(OURA_SLEEP_ENDPOINT, headers=headers, params=params, timeout=30)
-    resp.raise_for_status()
-    data = resp.json()
-    print("Sömn-JSON:", data)
-    data = data.get("data", [])
-    records = []
+    for entry in fetched:
+        entries = by_day.get(_entry_day(entry))
+        if entries is not None:
+            entries.append(entry)
+    for day_str, entries in by_day.items():
+        _write_cached_day(endpoint, _parse_date(day_str), entries)
+    data.extend(fetched)
+    return data
+
+
+def fetch_oura_sleep(start_date: dt.date, end_date: dt.date) -> SleepData:
+    """Fetch sleep data from Oura between start_date and end_date, sorted by date."""
+    data = _fetch_range(OURA_SLEEP_ENDPOINT, start_date, end_date)
+    # Formatting is deferred, so the dump costs nothing unless DEBUG is on
+    logger.debug("Sömn-JSON: %s", data)
+    dates = []
+    total_sleep = []
+    deep = []
+    rest_hr = []
 
     for d in data:
         date_str = d.get("day") or d.get("summary_date")
         if not date_str:
             continue
-        records.append(
-            SleepRecord(
-                date=dt.date.fromisoformat(date_str),
-                total_sleep_duration=d.get("total_sleep_duration", 0),
-                deep_sleep_duration=d.get("deep_sleep_duration"),
-                rest_hr=d.get("resting_heart_rate"),
-            )
+        # A night without total sleep would turn the correlation into NaN
+        total = d.get("total_sleep_duration")
+        if total is None:
+            logger.warning("Skipping %s: no total_sleep_duration in Oura data", date_str)
+            continue
+        dates.append(_parse_date(date_str))
+        total_sleep.append(total)
+        deep.append(d.get("deep_sleep_duration"))
+        rest_hr.append(d.get("resting_heart_rate"))
+
+    # None becomes NaN in the optional columns
+    sleep = SleepData(
+        date=np.array(dates, dtype="datetime64[D]"),
+        total_sleep=np.array(total_sleep, dtype=np.float64),
+        deep=np.array(deep, dtype=np.float64),
+        rest_hr=np.array(rest_hr, dtype=np.float64),
+    )
+    # Oura normally returns days in order, so only reorder when needed
+    if np.any(sleep.date[1:] < sleep.date[:-1]):
+        order = np.argsort(sleep.date, kind="stable")
+        sleep = SleepData(
+            date=sleep.date[order],
+            total_sleep=sleep.total_sleep[order],
+            deep=sleep.deep[order],
+            rest_hr=sleep.rest_hr[order],
         )
-
-    return records
+    return sleep
 
 
 def fetch_oura_cold_baths(start_date: dt.date, end_date: dt.date) -> List[ColdBathRecord]:
     """Detect cold baths from Oura workouts between start_date and end_date."""
-    token = CREDENTIALS["oura_token"]
-    if not token:
-        raise EnvironmentError("OURA_TOKEN is not set")
-    headers = {"Authorization": f"Bearer {token}"}
-    params = {
-        "start_date": start_date.isoformat(),
-        "end_date": end_date.isoformat(),
-    }
-    resp = requests.get(OURA_WORKOUT_ENDPOINT, headers=headers, params=params, timeout=30)
-    resp.raise_for_status()
-    data = resp.json().get("data", [])
+    data = _fetch_range(OURA_WORKOUT_ENDPOINT, start_date, end_date)
     records: List[ColdBathRecord] = []
     for w in data:
         start_str = w.get("start_datetime") or w.get("start_time")
         if not start_str:
             continue
-        # Handle trailing "Z" by converting to offset aware string
-        start_dt = dt.datetime.fromisoformat(start_str.replace("Z", "+00:00"))
+        # Only the wall-clock hour and date are needed, and both are read in
+        # the timestamp's own offset, so slice them instead of building a
+        # timezone-aware datetime
+        try:
+            hour = int(start_str[11:13])
+        except ValueError:
+            # Date-only or truncated timestamps carry no start hour to match
+            continue
         duration = float(w.get("duration", 0))
-        if 6 <= start_dt.hour < 10 and 120 <= duration <= 300:
-            records.append(ColdBathRecord(date=start_dt.date()))
+        if 6 <= hour < 10 and 120 <= duration <= 300:
+            records.append(ColdBathRecord(date=_parse_date(start_str[:10])))
     return records
 
 
+def _pearson_numpy(x: np.ndarray, bathed: np.ndarray) -> float:
+    """Return the correlation between ``x`` and the boolean mask ``bathed``."""
+    n = x.shape[0]
+    k = int(np.count_nonzero(bathed))
+    if k in (0, n):
+        return 0.0
+    # The bath indicator is 0/1, so its variance reduces to k(n - k)/n.
+    sum_x = x.sum()
+    cov = x[bathed].sum() - k * sum_x / n
+    var_sleep = x @ x - sum_x * sum_x / n
+    if var_sleep <= 0:
+        return 0.0
+    return float(cov / (var_sleep * k * (n - k) / n) ** 0.5)
+
+
+def _pearson_loop(x, bathed):
+    """Single-pass variant of :func:`_pearson_numpy` for compilation with numba."""
+    n = x.shape[0]
+    sum_x = 0.0
+    sum_xx = 0.0
+    sum_bath_x = 0.0
+    k = 0
+    for i in range(n):
+        v = x[i]
+        sum_x += v
+        sum_xx += v * v
+        if bathed[i]:
+            sum_bath_x += v
+            k += 1
+    if k == 0 or k == n:
+        return 0.0
+    var_sleep = sum_xx - sum_x * sum_x / n
+    if var_sleep <= 0:
+        return 0.0
+    cov = sum_bath_x - k * sum_x / n
+    return cov / (var_sleep * k * (n - k) / n) ** 0.5
+
+
+# Pearson kernel, chosen on first use so numba is only imported when needed
+_pearson: Optional[Callable[[np.ndarray, np.ndarray], float]] = None
+
+
+def _get_pearson() -> Callable[[np.ndarray, np.ndarray], float]:
+    """Return the Pearson kernel, compiling it with numba on first use if available."""
+    global _pearson
+    if _pearson is None:
+        try:
+            from numba import njit
+        except ModuleNotFoundError:  # pragma: no cover - optional speedup
+            _pearson = _pearson_numpy
+        else:
+            # cache=True keeps the compiled code on disk so daily runs skip the
+            # JIT step. fastmath is left off so NaN/inf handling matches the
+            # NumPy fallback exactly.
+            _pearson = njit(cache=True)(_pearson_loop)
+    return _pearson
+
+
+def _bath_mask(dates: np.ndarray, baths: List[ColdBathRecord]) -> np.ndarray:
+    """Return a boolean mask marking the entries of ``dates`` with a cold bath."""
+    bath_dates = np.array(list({b.date for b in baths}), dtype="datetime64[D]")
+    return np.isin(dates, bath_dates)
 
 
 def correlate_baths_sleep(
-    sleep: List[SleepRecord], baths: List[ColdBathRecord]
+    sleep: SleepData, baths: List[ColdBathRecord]
 ) -> float:
     """Return the correlation coefficient between cold baths and total sleep time."""
-    bath_dates = {b.date for b in baths}
-    paired = [
-        (s.total_sleep_duration, 1 if s.date in bath_dates else 0) for s in sleep
-    ]
-    if not paired:
-        return 0.0
-    mean_sleep = sum(x for x, _ in paired) / len(paired)
-    mean_bath = sum(y for _, y in paired) / len(paired)
-    var_sleep = sum((x - mean_sleep) ** 2 for x, _ in paired)
-    var_bath = sum((y - mean_bath) ** 2 for _, y in paired)
-    cov = sum((x - mean_sleep) * (y - mean_bath) for x, y in paired)
-    if var_sleep == 0 or var_bath == 0:
+    if not sleep or not baths:
         return 0.0
-    return cov / (var_sleep ** 0.5 * var_bath ** 0.5)
+    return float(_get_pearson()(sleep.total_sleep, _bath_mask(sleep.date, baths)))
+
+
+def _import_matplotlib():
+    """Import matplotlib on demand so loading the module for analysis stays cheap."""
+    try:
+        import matplotlib
+    except ModuleNotFoundError as exc:  # pragma: no cover - simple guard
+        raise SystemExit("The 'matplotlib' package is required. Install it via 'pip install matplotlib'.") from exc
+    return matplotlib
 
 
 def plot_sleep_vs_baths(
-    sleep: List[SleepRecord],
+    sleep: SleepData,
     baths: List[ColdBathRecord],
     out_path: str = "sleep_vs_coldbath.png",
+    fig: Optional["Figure"] = None,
 ) -> None:
-    """Create a bar plot showing sleep duration and mark days with cold baths."""
-    bath_dates = {b.date for b in baths}
-    sleep_sorted = sorted(sleep, key=lambda s: s.date)
-    dates = [s.date.strftime("%Y-%m-%d") for s in sleep_sorted]
-    hours = [s.total_sleep_duration / 3600 for s in sleep_sorted]
-    colors = ["tab:blue" if s.date in bath_dates else "tab:gray" for s in sleep_sorted]
-    plt.figure(figsize=(10, 4))
-    plt.bar(dates, hours, color=colors)
-
-    plt.ylabel("Sömn (timmar)")
-    plt.xticks(rotation=45, ha="right")
-    plt.tight_layout()
-    os.makedirs(os.path.dirname(out_path), exist_ok=True)
-    plt.savefig(out_path)
-    plt.close()
+    """Create a bar plot showing sleep duration and mark days with cold baths.
+
+    ``sleep`` is expected in date order, as returned by :func:`fetch_oura_sleep`,
+    and the directory of ``out_path`` must already exist.
+    Pass ``fig`` to redraw an existing figure, e.g. when rendering several
+    reports in a loop; it is cleared first and left open for the caller.
+    """
+    _import_matplotlib()
+    import matplotlib.pyplot as plt
+
+    hours = sleep.total_sleep / 3600
+    colors = np.where(_bath_mask(sleep.date, baths), "tab:blue", "tab:gray")
+    owns_fig = fig is None
+    if owns_fig:
+        fig, ax = plt.subplots(figsize=(10, 4))
+    else:
+        fig.clear()
+        ax = fig.add_subplot()
+    ax.bar(sleep.date.astype(str), hours, color=colors)
+
+    ax.set_ylabel("Sömn (timmar)")
+    plt.setp(ax.get_xticklabels(), rotation=45, ha="right")
+    fig.tight_layout()
+    fig.savefig(out_path)
+    if owns_fig:
+        plt.close(fig)
 
 
 def open_file_in_browser(path: str) -> None:
     """Open the given file in the default web browser."""
+    import webbrowser
+
     abs_path = os.path.abspath(path)
     webbrowser.open(f"file://{abs_path}")
 
@@ -161,15 +379,37 @@ def generate_html_report(image_path: str, html_path: str) -> None:
         f.write(html_content)
 
 
+def _configure_logging() -> None:
+    """Set the log level from ``OURA_LOG_LEVEL``, falling back to WARNING."""
+    level_name = os.getenv("OURA_LOG_LEVEL", "WARNING").upper()
+    # getLevelName maps known names to their numeric level and returns a
+    # string for anything else
+    level = logging.getLevelName(level_name)
+    if isinstance(level, int):
+        logging.basicConfig(level=level)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+        logger.warning("Unknown OURA_LOG_LEVEL %r, using WARNING", level_name)
+
+
 def main():
+    _configure_logging()
     start = dt.date.today() - dt.timedelta(days=30)
     end = dt.date.today()
-    sleep_data = fetch_oura_sleep(start, end)
-    baths = fetch_oura_cold_baths(start, end)
+    # Both requests share the pooled session, so run them side by side
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        sleep_future = executor.submit(fetch_oura_sleep, start, end)
+        baths_future = executor.submit(fetch_oura_cold_baths, start, end)
+        sleep_data = sleep_future.result()
+        baths = baths_future.result()
     corr = correlate_baths_sleep(sleep_data, baths)
     print(f"Correlation between cold baths and sleep duration: {corr:.2f}")
     filename = f"sleep_vs_coldbath_{dt.date.today().isoformat()}.png"
     out_path = os.path.join(EXPORT_DIR, filename)
+    _ensure_dir(EXPORT_DIR)
+    # The script only writes image files, so pick the non-GUI backend here
+    # rather than overriding the backend of code that imports this module
+    _import_matplotlib().use("Agg")
     plot_sleep_vs_baths(sleep_data, baths, out_path)
     html_path = os.path.join(EXPORT_DIR, "report.html")
     generate_html_report(out_path, html_path)